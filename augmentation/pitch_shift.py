@@ -1,6 +1,7 @@
 from copy import deepcopy
 
 from basics.base_augmentation import BaseAugmentation
+from data_gen.data_gen_utils import convert_mel_dtype
 from src.vocoders.base_vocoder import VOCODERS
 from utils.hparams import hparams
 from utils.pitch_utils import f0_to_coarse
@@ -18,7 +19,7 @@ class PitchShiftAugmentation(BaseAugmentation):
         else:
             _, mel = VOCODERS[hparams['vocoder'].split('.')[-1]].wav2spec(aug_item['wav_fn'], keyshift=key_shift)
         aug_item['key_shift'] = key_shift
-        aug_item['mel'] = mel
+        aug_item['mel'] = convert_mel_dtype(mel, hparams)
         aug_item['f0'] *= 2 ** (key_shift / 12)
         aug_item['pitch'] = f0_to_coarse(aug_item['f0'])
         if replace_spk_id is not None:
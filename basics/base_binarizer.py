@@ -2,16 +2,27 @@ import shutil
 import os
 os.environ["OMP_NUM_THREADS"] = "1"
 
-from utils.multiprocess_utils import chunked_multiprocess_run
+import collections
+import functools
+import itertools
+import multiprocessing
+import queue
 import random
+import threading
 import json
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import torch
 from resemblyzer import VoiceEncoder
 from tqdm import tqdm
-from data_gen.data_gen_utils import get_mel2ph, get_pitch_parselmouth, build_phone_encoder
+from data_gen.data_gen_utils import get_mel2ph, get_pitch_parselmouth, get_pitch_torchcrepe, build_phone_encoder, \
+    embed_utterances, quantize_spk_embed, MEL_DTYPES
 from utils.hparams import set_hparams, hparams
 from utils.phoneme_utils import build_phoneme_list
 import numpy as np
+from utils import MeanStdMeter
 from utils.indexed_datasets import IndexedDatasetBuilder
+from src.vocoders.base_vocoder import VOCODERS
 
 
 class BinarizationError(Exception):
@@ -71,15 +82,29 @@ class BaseBinarizer:
             self.load_meta_data(data_dir, ds_id)
             if ds_id == 0:
                 # check program correctness
-                assert all([attr in self.item_attributes for attr in list(self.items.values())[0].keys()])
+                first_item = next(iter(self.items.values()))
+                assert all(attr in self.item_attributes for attr in first_item.keys())
         self.item_names = sorted(list(self.items.keys()))
         
         if self.binarization_args['shuffle']:
             random.seed(hparams['seed'])
             random.shuffle(self.item_names)
         
-        # set default get_pitch algorithm
-        self.get_pitch_algorithm = get_pitch_parselmouth
+        # set get_pitch algorithm
+        pitch_extractor = hparams.get('pitch_extractor', 'parselmouth')
+        if pitch_extractor == 'parselmouth':
+            self.get_pitch_algorithm = get_pitch_parselmouth
+        elif pitch_extractor == 'torchcrepe':
+            self.get_pitch_algorithm = get_pitch_torchcrepe
+        else:
+            raise ValueError(f'Unknown pitch extractor: {pitch_extractor}')
+
+        mel_dtype = hparams.get('mel_dtype', 'fp32')
+        if mel_dtype not in MEL_DTYPES:
+            raise ValueError(f'Unknown mel dtype: {mel_dtype}')
+        spk_embed_dtype = hparams.get('spk_embed_dtype', 'fp32')
+        if spk_embed_dtype not in ['fp32', 'int8']:
+            raise ValueError(f'Unknown speaker embedding dtype: {spk_embed_dtype}')
 
     def load_meta_data(self, raw_data_dir, ds_id):
         raise NotImplementedError
@@ -104,33 +129,44 @@ class BaseBinarizer:
         assert len(spk_map) <= hparams['num_spk'], 'Actual number of speakers should be smaller than num_spk!'
         return spk_map
 
+    @functools.cached_property
+    def voice_encoder(self):
+        # loaded on first use and shared by all data splits
+        return VoiceEncoder().cuda().eval()
+
+    def __getstate__(self):
+        # the voice encoder is only used in the main process, do not send it to the workers
+        state = self.__dict__.copy()
+        state.pop('voice_encoder', None)
+        return state
+
     def item_name2spk_id(self, item_name):
         return self.spk_map[self.items[item_name]['spk_id']]
 
     def _phone_encoder(self):
-        ph_set = []
         # Just for ensuring the transcriptions match the dictionary.
         # May need refactoring in the future.
         dict_fn = os.path.join(hparams['binary_data_dir'], 'dictionary.txt')
         if hparams['reset_phone_dict'] or not os.path.exists(dict_fn):
-            self.load_ph_set(ph_set)  # For singing, do checking and return the correct results.
-            ph_set = sorted(set(ph_set))
+            ph_set = sorted(self.load_ph_set())  # For singing, do checking and return the correct results.
             shutil.copy(hparams['g2p_dictionary'], dict_fn)
         else:
             ph_set = build_phoneme_list()
         return build_phone_encoder(ph_set)
 
-    def load_ph_set(self, ph_set):
+    def load_ph_set(self) -> set:
         raise NotImplementedError
 
-    def meta_data_iterator(self, prefix):
+    def get_item_names(self, prefix):
         if prefix == 'valid':
-            item_names = self.valid_item_names
+            return self.valid_item_names
         elif prefix == 'test':
-            item_names = self.test_item_names
+            return self.test_item_names
         else:
-            item_names = self.train_item_names
-        for item_name in item_names:
+            return self.train_item_names
+
+    def meta_data_iterator(self, prefix):
+        for item_name in self.get_item_names(prefix):
             meta_data = self.items[item_name]
             yield item_name, meta_data
 
@@ -139,73 +175,121 @@ class BaseBinarizer:
         self.spk_map = self.build_spk_map()
         print("| spk_map: ", self.spk_map)
         spk_map_fn = f"{hparams['binary_data_dir']}/spk_map.json"
-        json.dump(self.spk_map, open(spk_map_fn, 'w', encoding='utf-8'))
+        with open(spk_map_fn, 'w', encoding='utf-8') as f:
+            json.dump(self.spk_map, f)
 
         self.phone_encoder = self._phone_encoder()
         self.process_data_split('valid')
         self.process_data_split('test')
         self.process_data_split('train', apply_augmentation=len(self.augmentation_args) > 0)
 
-    def process_data_split(self, prefix, multiprocess=False, apply_augmentation=False):
+    def process_data_split(self, prefix, multiprocess=True, apply_augmentation=False):
         data_dir = hparams['binary_data_dir']
-        args = []
-        builder = IndexedDatasetBuilder(f'{data_dir}/{prefix}')
-        lengths = []
-        f0s = []
+        args = ([item_name, meta_data] for item_name, meta_data in self.meta_data_iterator(prefix))
+        num_items = len(self.get_item_names(prefix))
+        num_workers = int(os.getenv('N_PROC', hparams.get('ds_workers', os.cpu_count() // 3))) \
+            if multiprocess else 0
+        aug_map = self.arrange_data_augmentation(prefix) if apply_augmentation else {}
+
         total_sec = 0
         total_raw_sec = 0
-
-        if self.binarization_args['with_spk_embed']:
-            voice_encoder = VoiceEncoder().cuda()
-
-        for item_name, meta_data in self.meta_data_iterator(prefix):
-            args.append([item_name, meta_data, self.binarization_args])
-
-        aug_map = self.arrange_data_augmentation(prefix) if apply_augmentation else {}
+        # items waiting for their speaker embeddings to be computed in one batch
+        pending_items = []
+        spk_embed_batch_size = hparams.get('spk_embed_batch_size', 32) \
+            if self.binarization_args['with_spk_embed'] else 1
 
         def postprocess(item_):
-            nonlocal total_sec, total_raw_sec
             if item_ is None:
                 return
-            item_['spk_embed'] = voice_encoder.embed_utterance(item_['wav']) \
-                if self.binarization_args['with_spk_embed'] else None
+            pending_items.append(item_)
+            if len(pending_items) >= spk_embed_batch_size:
+                flush()
+
+        def flush():
+            if len(pending_items) == 0:
+                return
+            if self.binarization_args['with_spk_embed']:
+                spk_embeds = embed_utterances(self.voice_encoder, [item_['wav'] for item_ in pending_items])
+                if hparams.get('spk_embed_dtype') == 'int8':
+                    spk_embeds = [quantize_spk_embed(spk_embed) for spk_embed in spk_embeds]
+            else:
+                spk_embeds = [None] * len(pending_items)
+            for item_, spk_embed in zip(pending_items, spk_embeds):
+                item_['spk_embed'] = spk_embed
+                add_item(item_)
+            pending_items.clear()
+
+        def add_item(item_):
+            nonlocal total_sec, total_raw_sec
             if not self.binarization_args['with_wav'] and 'wav' in item_:
                 del item_['wav']
-            builder.add_item(item_)
-            lengths.append(item_['len'])
+            write_queue.put(item_)
             total_sec += item_['sec']
             total_raw_sec += item_['sec']
-            if item_.get('f0') is not None:
-                f0s.append(item_['f0'])
 
             for task in aug_map.get(item_['item_name'], []):
                 aug_item = task['func'](item_, **task['kwargs'])
-                builder.add_item(aug_item)
-                lengths.append(aug_item['len'])
+                write_queue.put(aug_item)
                 total_sec += aug_item['sec']
-                if aug_item.get('f0') is not None:
-                    f0s.append(aug_item['f0'])
-
-        if multiprocess:
-            # code for parallel processing
-            num_workers = int(os.getenv('N_PROC', hparams.get('ds_workers', os.cpu_count() // 3)))
-            for item in tqdm(
-                chunked_multiprocess_run(self.process_item, args, num_workers=num_workers),
-                total=len(list(self.meta_data_iterator(prefix)))
-            ):
-                postprocess(item)
-        else:
-            # code for single cpu processing
-            for a in tqdm(args):
-                item = self.process_item(*a)
+
+        builder = IndexedDatasetBuilder(f'{data_dir}/{prefix}')
+        # lengths are streamed to a temporary file and f0 statistics are computed online,
+        # instead of keeping them in memory
+        lengths_fn = f'{data_dir}/{prefix}_lengths.bin'
+        lengths_file = open(lengths_fn, 'wb')
+        f0s_meter = MeanStdMeter()
+
+        # items are written to disk by a separate thread, so that writing overlaps with processing
+        write_queue = queue.Queue(maxsize=8)
+        write_errors = []
+
+        def write_items():
+            try:
+                while True:
+                    item_ = write_queue.get()
+                    if item_ is None:
+                        return
+                    builder.add_item(item_)
+                    lengths_file.write(np.int64(item_['len']).tobytes())
+                    if item_.get('f0') is not None:
+                        f0s_meter.update(item_['f0'][item_['f0'] != 0])
+            except BaseException as e:
+                write_errors.append(e)
+                # keep consuming so that the main thread never blocks on a full queue
+                while write_queue.get() is not None:
+                    pass
+
+        writer = threading.Thread(target=write_items, daemon=True)
+        writer.start()
+        results = self._iter_results(args, num_workers)
+        succeeded = False
+        try:
+            for item in tqdm(results, total=num_items):
+                # stop early if the writer has failed
+                if len(write_errors) > 0:
+                    break
                 postprocess(item)
-        
+            else:
+                flush()
+            succeeded = True
+        finally:
+            results.close()
+            write_queue.put(None)
+            writer.join()
+            lengths_file.close()
+            if not succeeded or len(write_errors) > 0:
+                # do not leave a truncated dataset behind
+                builder.out_file.close()
+                os.remove(f'{data_dir}/{prefix}.data')
+                os.remove(lengths_fn)
+        if len(write_errors) > 0:
+            raise write_errors[0]
+
         builder.finalize()
-        np.save(f'{data_dir}/{prefix}_lengths.npy', lengths)
-        if len(f0s) > 0:
-            f0s = np.concatenate(f0s, 0)
-            f0s = f0s[f0s != 0]
-            np.save(f'{data_dir}/{prefix}_f0s_mean_std.npy', [np.mean(f0s).item(), np.std(f0s).item()])
+        np.save(f'{data_dir}/{prefix}_lengths.npy', np.fromfile(lengths_fn, dtype=np.int64))
+        os.remove(lengths_fn)
+        if f0s_meter.cnt > 0:
+            np.save(f'{data_dir}/{prefix}_f0s_mean_std.npy', [float(f0s_meter.mean), float(f0s_meter.std)])
 
         if apply_augmentation:
             print(f'| {prefix} total duration (before augmentation): {total_raw_sec:.2f}s')
@@ -213,6 +297,43 @@ class BaseBinarizer:
         else:
             print(f'| {prefix} total duration: {total_raw_sec:.2f}s')
 
+    def _iter_results(self, args, num_workers):
+        if num_workers <= 1:
+            # code for single cpu processing
+            process_item = self._make_process_item()
+            for a in args:
+                yield process_item(*a)
+            return
+        # code for parallel processing
+        # Workers are spawned rather than forked because wav2spec may run on CUDA,
+        # which cannot be re-initialized in a forked subprocess.
+        # Tasks are submitted in chunks, and only a bounded number of chunks is in flight at a time,
+        # so that finished items (with their wav and mel) do not pile up while the main thread is busy.
+        chunk_size = 8
+        max_pending_chunks = 2 * num_workers
+        args = iter(args)
+        pending = collections.deque()
+        with ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self, dict(hparams))
+        ) as executor:
+            try:
+                while True:
+                    while len(pending) < max_pending_chunks:
+                        chunk = list(itertools.islice(args, chunk_size))
+                        if len(chunk) == 0:
+                            break
+                        pending.append(executor.submit(_process_items, chunk))
+                    if len(pending) == 0:
+                        return
+                    # results are yielded in order
+                    yield from pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
     def arrange_data_augmentation(self, prefix):
         """
         Code for all types of data augmentation should be added here.
@@ -278,9 +399,22 @@ class BaseBinarizer:
 
         return aug_map
 
-    def process_item(self, item_name, meta_data, binarization_args):
+    def _make_process_item(self):
+        '''
+            Resolve the vocoder and the binarization args once and bind them to process_item,
+            so that the returned function only takes (item_name, meta_data).
+        '''
+        if hparams['vocoder'] in VOCODERS:
+            vocoder_cls = VOCODERS[hparams['vocoder']]
+        else:
+            vocoder_cls = VOCODERS[hparams['vocoder'].split('.')[-1]]
+        return functools.partial(self.process_item, binarization_args=self.binarization_args, vocoder_cls=vocoder_cls)
+
+    def process_item(self, item_name, meta_data, binarization_args, vocoder_cls=None):
         from preprocessing.opencpop import File2Batch
-        return File2Batch.temporary_dict2processed_input(item_name, meta_data, self.phone_encoder, binarization_args)
+        return File2Batch.temporary_dict2processed_input(item_name, meta_data, self.phone_encoder, binarization_args,
+                                                         get_pitch_algorithm=self.get_pitch_algorithm,
+                                                         vocoder_cls=vocoder_cls)
 
     def get_align(self, meta_data, mel, phone_encoded, res):
         raise NotImplementedError
@@ -310,17 +444,45 @@ class BaseBinarizer:
         return
         from utils.cwt import get_cont_lf0, get_lf0_cwt
         uv, cont_lf0_lpf = get_cont_lf0(f0)
-        logf0s_mean_org, logf0s_std_org = np.mean(cont_lf0_lpf), np.std(cont_lf0_lpf)
-        cont_lf0_lpf_norm = (cont_lf0_lpf - logf0s_mean_org) / logf0s_std_org
+        cont_lf0_lpf = np.asarray(cont_lf0_lpf, dtype=np.float32)
+        logf0s_mean_org = float(cont_lf0_lpf.mean())
+        # normalize in place: the centered buffer gives the std with one dot product
+        cont_lf0_lpf_norm = np.subtract(cont_lf0_lpf, logf0s_mean_org, out=cont_lf0_lpf)
+        logf0s_std_org = float(np.sqrt(np.dot(cont_lf0_lpf_norm, cont_lf0_lpf_norm) / len(cont_lf0_lpf_norm)))
+        cont_lf0_lpf_norm /= logf0s_std_org
         Wavelet_lf0, scales = get_lf0_cwt(cont_lf0_lpf_norm)
-        if np.any(np.isnan(Wavelet_lf0)):
+        if np.isnan(Wavelet_lf0).any():
             raise BinarizationError("NaN CWT")
-        res['cwt_spec'] = Wavelet_lf0
+        res['cwt_spec'] = Wavelet_lf0.astype(np.float32)
         res['cwt_scales'] = scales
         res['f0_mean'] = logf0s_mean_org
         res['f0_std'] = logf0s_std_org
 
 
+_worker_process_item = None
+
+
+def _init_worker(binarizer, hparams_):
+    global _worker_process_item
+    os.environ["OMP_NUM_THREADS"] = "1"
+    torch.set_num_threads(1)
+    # hparams may have been modified in the main process, so do not reload them from the config
+    hparams.clear()
+    hparams.update(hparams_)
+    _worker_process_item = binarizer._make_process_item()
+
+
+def _process_items(chunk):
+    results = []
+    for args in chunk:
+        try:
+            results.append(_worker_process_item(*args))
+        except:
+            traceback.print_exc()
+            results.append(None)
+    return results
+
+
 if __name__ == "__main__":
     set_hparams()
     BaseBinarizer().process()
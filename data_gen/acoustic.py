@@ -128,12 +128,12 @@ class AcousticBinarizer(BaseBinarizer):
                     pad_inches=0.25)
         print(f'| save summary to \'{filename}\'')
 
-    def load_ph_set(self, ph_set):
+    def load_ph_set(self) -> set:
         # load those phones that appear in the actual data
+        actual_phone_set = set()
         for item in self.items.values():
-            ph_set += item['ph'].split(' ')
+            actual_phone_set.update(item['ph'].split(' '))
         # check unrecognizable or missing phones
-        actual_phone_set = set(ph_set)
         required_phone_set = set(build_phoneme_list())
         self.generate_summary(required_phone_set)
         if actual_phone_set != required_phone_set:
@@ -142,3 +142,4 @@ class AcousticBinarizer(BaseBinarizer):
             raise AssertionError('transcriptions and dictionary mismatch.\n'
                                  f' (+) {sorted(unrecognizable_phones)}\n'
                                  f' (-) {sorted(missing_phones)}')
+        return actual_phone_set
@@ -147,6 +147,19 @@ def process_utterance(wav_path,
         return wav, mel, spc
 
 
+MEL_DTYPES = {'fp32': np.float32, 'fp16': np.float16}
+
+
+def convert_mel_dtype(mel, hparams):
+    """
+
+    :param mel: [T, 80]
+    :param hparams:
+    :return: mel in the dtype given by hparams['mel_dtype'] (fp32 or fp16)
+    """
+    return mel.astype(MEL_DTYPES[hparams.get('mel_dtype', 'fp32')], copy=False)
+
+
 def get_pitch_parselmouth(wav_data, mel, hparams):
     """
 
@@ -168,6 +181,133 @@ def get_pitch_parselmouth(wav_data, mel, hparams):
     return f0, pitch_coarse
 
 
+def get_pitch_torchcrepe(wav_data, mel, hparams, threshold=0.3, device=None):
+    """
+    Falls back to parselmouth if no device is given and CUDA is not available.
+
+    :param wav_data: [T]
+    :param mel: [T, 80]
+    :param hparams:
+    :param threshold: periodicity threshold for voiced frames
+    :param device: torch device to run crepe on, defaults to CUDA
+    :return:
+    """
+    if device is None:
+        if not torch.cuda.is_available():
+            return get_pitch_parselmouth(wav_data, mel, hparams)
+        device = torch.device('cuda')
+    import torchcrepe
+    import resampy
+    f0_min = 65
+    f0_max = 800
+
+    # every pool worker loads its own copy of the model, so the small one is used by default
+    model = hparams.get('crepe_model', 'tiny')
+
+    # crepe only works at 16 kHz; resample here and analyse with a 5 ms hop (80 samples),
+    # otherwise torchcrepe resamples internally and rounds the hop, so the f0 drifts from the mel frames
+    wav16k = resampy.resample(wav_data, hparams['audio_sample_rate'], 16000)
+    wav16k_torch = torch.FloatTensor(wav16k).unsqueeze(0).to(device)
+    f0, pd = torchcrepe.predict(wav16k_torch, 16000, 80, f0_min, f0_max, pad=True, model=model,
+                                batch_size=2048, device=device, return_periodicity=True)
+    pd = torchcrepe.filter.median(pd, 3)
+    pd = torchcrepe.threshold.Silence(-60.)(pd, wav16k_torch, 16000, 80)
+    f0 = torchcrepe.threshold.At(threshold)(f0, pd)
+    f0 = torchcrepe.filter.mean(f0, 3)
+    f0 = torch.where(torch.isnan(f0), torch.full_like(f0, 0), f0)[0].cpu().numpy()
+
+    # interpolate the voiced f0 onto the mel frames
+    uv = f0 == 0
+    time_org = 0.005 * np.arange(len(f0))
+    time_frame = np.arange(len(mel)) * hparams['hop_size'] / hparams['audio_sample_rate']
+    if uv.all():
+        f0 = np.zeros(len(mel))
+    else:
+        f0 = np.interp(time_frame, time_org[~uv], f0[~uv])
+        # unvoiced frames are set to 0 as parselmouth does
+        uv_frame = uv[np.clip(np.round(time_frame / 0.005).astype(np.int64), 0, len(uv) - 1)]
+        f0[uv_frame] = 0
+    pitch_coarse = f0_to_coarse(f0)
+    return f0, pitch_coarse
+
+
+def embed_utterances(voice_encoder, wavs, rate=1.3, min_coverage=0.75):
+    """
+    Batched version of VoiceEncoder.embed_utterance: the partial utterances of all
+    waveforms are stacked and fed to the encoder in one forward pass.
+
+    :param voice_encoder: resemblyzer.VoiceEncoder
+    :param wavs: list of [T]
+    :param rate, min_coverage: see VoiceEncoder.compute_partial_slices
+    :return: list of [256]
+    """
+    from resemblyzer.audio import wav_to_mel_spectrogram
+    partial_mels = []
+    num_partials = []
+    for wav in wavs:
+        wav_slices, mel_slices = voice_encoder.compute_partial_slices(len(wav), rate, min_coverage)
+        max_wave_length = wav_slices[-1].stop
+        if max_wave_length >= len(wav):
+            wav = np.pad(wav, (0, max_wave_length - len(wav)), 'constant')
+        mel = wav_to_mel_spectrogram(wav)
+        partial_mels.extend(mel[s] for s in mel_slices)
+        num_partials.append(len(mel_slices))
+    mels = torch.from_numpy(np.stack(partial_mels))
+    if torch.device(voice_encoder.device).type == 'cuda':
+        partial_embeds = _voice_encoder_forward_overlapped(voice_encoder, mels)
+    else:
+        with torch.no_grad():
+            partial_embeds = voice_encoder(mels.to(voice_encoder.device)).cpu().numpy()
+    embeds = []
+    for partial_embeds_ in np.split(partial_embeds, np.cumsum(num_partials)[:-1]):
+        raw_embed = np.mean(partial_embeds_, axis=0)
+        embeds.append(raw_embed / np.linalg.norm(raw_embed, 2))
+    return embeds
+
+
+def quantize_spk_embed(spk_embed):
+    """
+
+    :param spk_embed: [256]
+    :return: int8 [256] and float32 scale, where spk_embed ~= int8 * scale
+    """
+    scale = np.float32(np.abs(spk_embed).max() / 127)
+    if scale == 0:
+        scale = np.float32(1.)
+    return np.round(spk_embed / scale).astype(np.int8), scale
+
+
+def _voice_encoder_forward_overlapped(voice_encoder, mels, chunk_size=64):
+    """
+    Run the voice encoder chunk by chunk, copying the next chunk from pinned memory
+    to the GPU on a side stream while the current chunk is being encoded.
+
+    :param voice_encoder: resemblyzer.VoiceEncoder on CUDA
+    :param mels: [N, T, 40]
+    :return: [N, 256]
+    """
+    device = torch.device(voice_encoder.device)
+    copy_stream = torch.cuda.Stream(device)
+    compute_stream = torch.cuda.current_stream(device)
+    # pin_memory() goes through the caching host allocator, so the staging buffers are reused
+    chunks = mels.pin_memory().split(chunk_size)
+    outputs = []
+    with torch.no_grad():
+        with torch.cuda.stream(copy_stream):
+            next_chunk = chunks[0].to(device, non_blocking=True)
+        for i in range(len(chunks)):
+            compute_stream.wait_stream(copy_stream)
+            chunk = next_chunk
+            # chunk was allocated on copy_stream but is consumed on compute_stream
+            chunk.record_stream(compute_stream)
+            if i + 1 < len(chunks):
+                with torch.cuda.stream(copy_stream):
+                    next_chunk = chunks[i + 1].to(device, non_blocking=True)
+            outputs.append(voice_encoder(chunk))
+        # copying back to the host synchronizes compute_stream, so all embeddings are ready in order
+        return torch.cat(outputs).cpu().numpy()
+
+
 def remove_empty_lines(text):
     """remove empty lines"""
     assert (len(text) > 0)
@@ -327,3 +467,22 @@ def build_phone_encoder(phone_list):
 
 def is_sil_phoneme(p):
     return not p[0].isalpha()
+
+
+if __name__ == '__main__':
+    # check that the crepe f0 lines up with the parselmouth f0 on the mel frames
+    hparams = {'audio_sample_rate': 44100, 'hop_size': 512, 'crepe_model': 'full'}
+    wav, _ = librosa.load('pipelines/assets/2001000001.wav', sr=hparams['audio_sample_rate'])
+    mel = np.zeros([len(wav) // hparams['hop_size'], 128])
+    f0_pm, _ = get_pitch_parselmouth(wav, mel, hparams)
+    f0_crepe, _ = get_pitch_torchcrepe(wav, mel, hparams, device=torch.device('cpu'))
+    assert len(f0_pm) == len(f0_crepe) == len(mel)
+    errors = {}
+    for shift in range(-3, 4):
+        a = f0_pm[max(shift, 0):len(mel) + min(shift, 0)]
+        b = f0_crepe[max(-shift, 0):len(mel) + min(-shift, 0)]
+        voiced = (a > 0) & (b > 0)
+        errors[shift] = np.median(np.abs(1200 * np.log2(a[voiced] / b[voiced])))
+        print(f'shift {shift}: {voiced.sum()} voiced frames, median error {errors[shift]:.2f} cents')
+    assert min(errors, key=errors.get) == 0, 'crepe f0 is shifted against parselmouth f0'
+    assert errors[0] < 50, 'crepe f0 does not match parselmouth f0'
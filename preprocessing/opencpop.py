@@ -1,6 +1,7 @@
 '''
     file -> temporary_dict -> processed_input -> batch
 '''
+import hashlib
 import os
 import traceback
 
@@ -10,7 +11,7 @@ from librosa import note_to_midi
 
 import utils
 from basics.base_binarizer import BinarizationError
-from data_gen.data_gen_utils import get_pitch_parselmouth
+from data_gen.data_gen_utils import get_pitch_parselmouth, convert_mel_dtype
 from src.vocoders.base_vocoder import VOCODERS
 from tts.data_gen.txt_processors.zh_g2pM import get_all_vowels
 from utils.hparams import hparams
@@ -56,20 +57,21 @@ class File2Batch:
         return all_temp_dict
 
     @staticmethod
-    def temporary_dict2processed_input(item_name, temp_dict, encoder, binarization_args):
+    def temporary_dict2processed_input(item_name, temp_dict, encoder, binarization_args,
+                                       get_pitch_algorithm=get_pitch_parselmouth, vocoder_cls=None):
         '''
             process data in temporary_dicts
         '''
 
         def get_pitch(wav, mel):
-            # get ground truth f0 by self.get_pitch_algorithm
+            # get ground truth f0 by get_pitch_algorithm
             f0_path = f"{temp_dict['wav_fn'][:-4]}_f0.npy"
             if os.path.exists(f0_path):
                 from utils.pitch_utils import f0_to_coarse
                 processed_input['f0'] = np.load(f0_path)
                 processed_input['pitch'] = f0_to_coarse(np.load(f0_path))
             else:
-                gt_f0, gt_pitch_coarse = get_pitch_parselmouth(wav, mel, hparams)
+                gt_f0, gt_pitch_coarse = get_pitch_algorithm(wav, mel, hparams)
                 if sum(gt_f0) == 0:
                     raise BinarizationError("Empty **gt** f0")
                 processed_input['f0'] = gt_f0
@@ -95,12 +97,10 @@ class File2Batch:
             mel = np.load(mel_path)
             print("load mel from npy")
         else:
-            if hparams['vocoder'] in VOCODERS:
-                wav, mel = VOCODERS[hparams['vocoder']].wav2spec(temp_dict['wav_fn'])
-            else:
-                wav, mel = VOCODERS[hparams['vocoder'].split('.')[-1]].wav2spec(temp_dict['wav_fn'])
+            wav, mel = File2Batch.wav2spec(temp_dict['wav_fn'], use_cache=binarization_args.get('cache_mel', False),
+                                           vocoder_cls=vocoder_cls)
         processed_input = {
-            'item_name': item_name, 'mel': mel, 'wav': wav,
+            'item_name': item_name, 'mel': convert_mel_dtype(mel, hparams), 'wav': wav,
             'sec': len(mel) * hparams["hop_size"] / hparams["audio_sample_rate"], 'len': mel.shape[0]
         }
         processed_input = {**temp_dict, **processed_input}  # merge two dicts
@@ -122,6 +122,40 @@ class File2Batch:
             return None
         return processed_input
 
+    @staticmethod
+    def wav2spec(wav_fn, use_cache=False, vocoder_cls=None):
+        '''
+            get wav and mel by the vocoder; if use_cache == True, the results are cached on disk,
+            keyed by the audio file and the mel settings, so that they are computed only once
+        '''
+        if vocoder_cls is None:
+            if hparams['vocoder'] in VOCODERS:
+                vocoder_cls = VOCODERS[hparams['vocoder']]
+            else:
+                vocoder_cls = VOCODERS[hparams['vocoder'].split('.')[-1]]
+        if not use_cache:
+            return vocoder_cls.wav2spec(wav_fn)
+
+        # the key covers every hparam read by the wav2spec of any registered vocoder
+        key = '|'.join(str(x) for x in [
+            os.path.abspath(wav_fn), os.path.getmtime(wav_fn), vocoder_cls.__name__,
+            hparams['audio_sample_rate'], hparams['audio_num_mel_bins'], hparams['fft_size'],
+            hparams['win_size'], hparams['hop_size'], hparams['fmin'], hparams['fmax'],
+            hparams.get('loud_norm'), hparams.get('min_level_db'), hparams.get('wav2spec_eps')
+        ])
+        key = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        cache_fn = os.path.join(hparams['binary_data_dir'], '_cache', f'{key}.npz')
+        if os.path.exists(cache_fn):
+            with np.load(cache_fn) as cache:
+                return cache['wav'], cache['mel']
+        wav, mel = vocoder_cls.wav2spec(wav_fn)
+        os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+        # write to a temporary file first so that other workers never see a partial cache file
+        tmp_fn = f'{cache_fn[:-4]}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_fn, wav=wav, mel=mel)
+        os.replace(tmp_fn, cache_fn)
+        return wav, mel
+
     @staticmethod
     def processed_input2batch(samples):
         '''
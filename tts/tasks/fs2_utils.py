@@ -61,7 +61,8 @@ class FastSpeechDataset(BaseDataset):
         hparams = self.hparams
         item = self._get_item(index)
         max_frames = hparams['max_frames']
-        spec = torch.Tensor(item['mel'])[:max_frames]
+        # mels may be stored in float16 (see mel_dtype)
+        spec = torch.from_numpy(item['mel'][:max_frames].astype(np.float32))
         # energy = (spec.exp() ** 2).sum(-1).sqrt()
         mel2ph = torch.LongTensor(item['mel2ph'])[:max_frames] if 'mel2ph' in item else None
         f0, uv = norm_interp_f0(item["f0"][:max_frames], hparams)
@@ -85,7 +86,12 @@ class FastSpeechDataset(BaseDataset):
         if self.hparams.get('use_key_shift_embed', False):
             sample['key_shift'] = item['key_shift']
         if self.hparams['use_spk_embed']:
-            sample["spk_embed"] = torch.Tensor(item['spk_embed'])
+            spk_embed = item['spk_embed']
+            if isinstance(spk_embed, tuple):
+                # int8 embedding and its scale (see spk_embed_dtype)
+                spk_embed_int8, scale = spk_embed
+                spk_embed = spk_embed_int8.astype(np.float32) * scale
+            sample["spk_embed"] = torch.Tensor(spk_embed)
         if self.hparams['use_spk_id']:
             sample["spk_id"] = item['spk_id']
             # sample['spk_id'] = 0
@@ -41,6 +41,34 @@ class AvgrageMeter(object):
         self.avg = self.sum / self.cnt
 
 
+class MeanStdMeter(object):
+    """Running mean and standard deviation, updated chunk by chunk (Chan et al.)."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.mean = 0.
+        self.m2 = 0.
+        self.cnt = 0
+
+    def update(self, values):
+        n = len(values)
+        if n == 0:
+            return
+        mean = np.mean(values, dtype=np.float64)
+        m2 = np.sum(np.square(values - mean), dtype=np.float64)
+        delta = mean - self.mean
+        cnt = self.cnt + n
+        self.mean += delta * n / cnt
+        self.m2 += m2 + delta ** 2 * self.cnt * n / cnt
+        self.cnt = cnt
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.cnt) if self.cnt > 0 else 0.
+
+
 def collate_1d(values, pad_idx=0, left_pad=False, shift_right=False, max_len=None, shift_id=1):
     """Convert a list of 1d tensors into a padded 2d tensor."""
     size = max(v.size(0) for v in values) if max_len is None else max_len
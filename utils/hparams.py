@@ -1,14 +1,14 @@
 import argparse
 import multiprocessing
 import os
-import re
 import shutil
 
 import yaml
 
 global_print_hparams = True
 hparams = {}
-is_main_process = not bool(re.match(r'Process-\d+', multiprocessing.current_process().name))
+# spawned and forked workers (e.g. binarizer pool workers re-importing the main script) are not the main process
+is_main_process = multiprocessing.parent_process() is None
 
 
 class Args:
@@ -39,17 +39,28 @@ class IndexedDataset:
         return len(self.data_offsets) - 1
 
 class IndexedDatasetBuilder:
-    def __init__(self, path):
+    def __init__(self, path, write_buffer_size=64):
         self.path = path
         self.out_file = open(f"{path}.data", 'wb')
         self.byte_offsets = [0]
+        # pickled items are written to disk in batches of write_buffer_size
+        self.write_buffer_size = write_buffer_size
+        self.pending = []
 
     def add_item(self, item):
         s = pickle.dumps(item)
-        bytes = self.out_file.write(s)
-        self.byte_offsets.append(self.byte_offsets[-1] + bytes)
+        self.pending.append(s)
+        self.byte_offsets.append(self.byte_offsets[-1] + len(s))
+        if len(self.pending) >= self.write_buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            self.out_file.write(b''.join(self.pending))
+            self.pending.clear()
 
     def finalize(self):
+        self.flush()
         self.out_file.close()
         np.save(open(f"{self.path}.idx", 'wb'), {'offsets': self.byte_offsets})
 
@@ -190,9 +190,8 @@ class TokenTextEncoder(TextEncoder):
 
     def encode(self, s):
         """Converts a space-separated string of tokens to a list of ids."""
-        sentence = s
-        tokens = sentence.strip().split()
-        ret = [self._token_to_id[tok] for tok in tokens]
+        # map() over the bound dict lookup avoids a Python-level attribute chain per token
+        ret = list(map(self._token_to_id.__getitem__, s.split()))
         return ret[::-1] if self._reverse else ret
 
     def decode(self, ids, strip_eos=False, strip_padding=False):